@@ -1,130 +1,399 @@
 # agent.py
 import os
-import io
+import re
+import math
+import json
+import hashlib
+import functools
+from collections import Counter
 import requests
-import pypdf
-import trafilatura
-import google.generativeai as genai
-from tavily import TavilyClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # --- NEW: DATABASE SETUP (using SQLAlchemy) ---
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
-from sqlalchemy.orm import declarative_base, sessionmaker
-
-# Define the database connection
-DATABASE_URL = "sqlite:///research_reports.db"
-engine = create_engine(DATABASE_URL)
-Base = declarative_base()
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Define the Report table model
-class Report(Base):
-    __tablename__ = "reports"
-    id = Column(Integer, primary_key=True, index=True)
-    query = Column(String, index=True)
-    report_content = Column(Text)
-    sources = Column(Text) # Storing sources as a comma-separated string
-    timestamp = Column(DateTime, default=datetime.utcnow)
-
-# Create the table in the database if it doesn't exist
-Base.metadata.create_all(bind=engine)
+# The schema lives in db.py so agent.py and app.py share one definition and one migration path
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from db import SessionLocal, Report, CacheEntry, UrlCacheEntry, init_db
+from pdf_text import extract_pdf_text
 # --- END NEW SECTION ---
 
 
 # --- 1. SETUP ---
-# Load environment variables from .env file
-load_dotenv()
+# Setup runs in setup() rather than at import: the spawned PDF workers re-import this module
+# as __mp_main__ when agent.py is run as a script, and app.py imports it as a library
+def setup():
+    """Loads the .env file, checks the API keys and creates or upgrades the database schema."""
+    load_dotenv()
 
-# Configure the API clients
-try:
+    # Check the API keys; the clients themselves are created on first use
+    if not (os.getenv("GEMINI_API_KEY") and os.getenv("TAVILY_API_KEY")):
+        print("Error: One or more API keys not found. Make sure they are in your .env file.")
+        exit()
+
+    init_db()
+
+# The client libraries (gRPC, lxml, ...) are slow to import, so they are loaded lazily
+@functools.lru_cache(maxsize=1)
+def _genai():
+    """Imports and configures the Gemini client."""
+    import google.generativeai as genai
     genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
-except TypeError:
-    print("Error: One or more API keys not found. Make sure they are in your .env file.")
-    exit()
+    return genai
+
+@functools.lru_cache(maxsize=1)
+def _tavily_client():
+    """Imports and creates the Tavily client."""
+    from tavily import TavilyClient
+    return TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
+
+@functools.lru_cache(maxsize=None)
+def _gemini_model(system_instruction: str):
+    """Returns the Gemini model configured with the given system instruction."""
+    return _genai().GenerativeModel('gemini-1.5-flash', system_instruction=system_instruction)
+
+# Fixed prompt instructions are sent as system instructions, so each call only carries the query and text
+NOTES_INSTRUCTIONS = """
+Extract the facts, figures and conclusions from the following text that are relevant to the user query.
+Reply with concise notes only.
+"""
+REPORT_INSTRUCTIONS = """
+Based on the following extracted text and the original user query, create a short, structured report.
+The report must include:
+1. A clear, relevant title.
+2. A brief summary of the main topics.
+3. A few key bullet points highlighting the most important findings.
+"""
+
+# Variable part of every summarization request, shared by the notes and report steps
+PROMPT_TEMPLATE = 'Original User Query: "{query}"\n\nExtracted Text:\n---\n{text}\n---'
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+
+@functools.lru_cache(maxsize=1)
+def _http_session():
+    """Returns the shared HTTP session, so repeat hosts reuse pooled keep-alive connections."""
+    session = requests.Session()
+    session.headers.update({'User-Agent': USER_AGENT})
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.3))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Upper bound on how much of a response body we read into memory per URL
+MAX_CONTENT_BYTES = 10 * 1024 * 1024
 
-# Instantiate the Gemini model
-gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+# Leading bytes of binary formats (images, audio/video, archives) that have no text worth extracting
+BINARY_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"RIFF", b"\x1aE\xdf\xa3", b"ID3", b"OggS", b"fLaC", b"PK\x03\x04", b"\x1f\x8b")
 
 
 # --- 2. CORE FUNCTIONS ---
 
+# How long cached search results and summaries stay valid
+CACHE_TTL = timedelta(days=1)
+
+# How long scraped page text is reused before the page is revalidated with the server
+URL_CACHE_TTL = timedelta(hours=24)
+
+def cached(is_cacheable=bool):
+    """Caches a function's JSON-serializable result in the database, keyed on its arguments."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            payload = json.dumps([func.__name__, args, kwargs], sort_keys=True)
+            key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            db = SessionLocal()
+            try:
+                entry = db.get(CacheEntry, key)
+                if entry is not None and datetime.utcnow() - entry.created_at < CACHE_TTL:
+                    print(f"⚡ Cache hit for {func.__name__}.")
+                    return json.loads(entry.value)
+            finally:
+                db.close()
+
+            result = func(*args, **kwargs)
+            # Failed calls are not cached so they get retried next time
+            if is_cacheable(result):
+                # An atomic upsert, so concurrent callers computing the same key don't collide on insert
+                stmt = sqlite_insert(CacheEntry).values(key=key, value=json.dumps(result), created_at=datetime.utcnow())
+                stmt = stmt.on_conflict_do_update(index_elements=[CacheEntry.key],
+                                                  set_={"value": stmt.excluded.value, "created_at": stmt.excluded.created_at})
+                db = SessionLocal()
+                try:
+                    db.execute(stmt)
+                    db.commit()
+                except SQLAlchemyError as e:
+                    # Caching is best-effort: a locked database must not fail the call itself
+                    print(f"Error while caching {func.__name__} result: {e}")
+                    db.rollback()
+                finally:
+                    db.close()
+            return result
+        return wrapper
+    return decorator
+
+def is_summary(result):
+    """Tells a generated summary apart from the error messages returned in its place."""
+    return bool(result) and not result.startswith(("Error:", "An error occurred"))
+
+# Minimum cosine similarity for a previous report to answer a new query
+SIMILARITY_THRESHOLD = 0.92
+
+# Older reports are never reused, so a query is eventually researched again with fresh sources
+SIMILAR_REPORT_MAX_AGE = timedelta(days=7)
+
+def embed_query(query: str):
+    """Embeds the query with Gemini, returning a float32 vector (or None on failure)."""
+    import numpy as np
+    try:
+        result = _genai().embed_content(model="models/text-embedding-004", content=query, task_type="semantic_similarity")
+        return np.asarray(result["embedding"], dtype=np.float32)
+    except Exception as e:
+        print(f"Error while embedding query: {e}")
+        return None
+
+def find_similar_report(query_embedding):
+    """Returns the recent stored report whose query is most similar to the given embedding, if close enough."""
+    import numpy as np
+    db = SessionLocal()
+    try:
+        rows = (db.query(Report.id, Report.embedding)
+                .filter(Report.embedding.isnot(None), Report.timestamp >= datetime.utcnow() - SIMILAR_REPORT_MAX_AGE)
+                .all())
+        if not rows:
+            return None
+
+        try:
+            matrix = np.vstack([np.frombuffer(row.embedding, dtype=np.float16) for row in rows]).astype(np.float32)
+            similarities = matrix @ query_embedding / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_embedding))
+        except ValueError as e:
+            # Embeddings of different sizes (e.g. after an embedding model change) can't be compared
+            print(f"Error while comparing query embeddings: {e}")
+            return None
+        best = int(np.argmax(similarities))
+        if similarities[best] <= SIMILARITY_THRESHOLD:
+            return None
+        return db.get(Report, rows[best].id)
+    finally:
+        db.close()
+
+@cached()
 def search_online(query: str, max_results=3):
     """Searches online using Tavily and returns a list of URLs."""
     print(f"🔎 Searching online for: '{query}'...")
     try:
-        response = tavily_client.search(query=query, search_depth="basic", max_results=max_results)
+        response = _tavily_client().search(query=query, search_depth="basic", max_results=max_results)
         return [obj["url"] for obj in response["results"]]
     except Exception as e:
         print(f"Error during online search: {e}")
         return []
 
+def extract_html_text(html: str):
+    """Extracts the main text of an HTML page, trying trafilatura's fast path before the full pipeline."""
+    import trafilatura
+    # fast=True skips the readability/justext fallback extractors, which dominate the CPU cost
+    text = trafilatura.extract(html, fast=True, include_comments=False, deduplicate=True)
+    if text is None:
+        text = trafilatura.extract(html)
+    return text
+
+def _save_url_content(url_key: str, content: str, response_headers, previous=None):
+    """Stores scraped page text in the URL cache; failures are logged so the text is still used."""
+    # A 304 may omit the validators, so keep the previously stored ones in that case
+    stmt = sqlite_insert(UrlCacheEntry).values(
+        url_sha256=url_key,
+        content=content,
+        fetched_at=datetime.utcnow(),
+        etag=response_headers.get('ETag') or (previous.etag if previous else None),
+        last_modified=response_headers.get('Last-Modified') or (previous.last_modified if previous else None)
+    )
+    stmt = stmt.on_conflict_do_update(index_elements=[UrlCacheEntry.url_sha256], set_={
+        "content": stmt.excluded.content,
+        "fetched_at": stmt.excluded.fetched_at,
+        "etag": stmt.excluded.etag,
+        "last_modified": stmt.excluded.last_modified
+    })
+    db = SessionLocal()
+    try:
+        db.execute(stmt)
+        db.commit()
+    except SQLAlchemyError as e:
+        print(f"Error while caching URL content: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
 def extract_content_from_url(url: str):
     """Extracts clean text content from a given URL (handles HTML and PDF)."""
+    url_key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    db = SessionLocal()
+    try:
+        cached_page = db.get(UrlCacheEntry, url_key)
+    finally:
+        db.close()
+    if cached_page is not None and datetime.utcnow() - cached_page.fetched_at < URL_CACHE_TTL:
+        print(f"⚡ Using cached content for: {url}")
+        return cached_page.content
+
     print(f"🕸️  Scraping content from: {url}...")
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'}
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-
-        if 'application/pdf' in response.headers.get('Content-Type', ''):
-            with io.BytesIO(response.content) as f:
-                reader = pypdf.PdfReader(f)
-                text = "".join(page.extract_text() for page in reader.pages)
+        # Revalidate a stale cached page so an unchanged one costs a 304 instead of a download
+        headers = {}
+        if cached_page is not None:
+            if cached_page.etag:
+                headers['If-None-Match'] = cached_page.etag
+            if cached_page.last_modified:
+                headers['If-Modified-Since'] = cached_page.last_modified
+
+        with _http_session().get(url, headers=headers, stream=True, timeout=(3, 10)) as response: # (connect, read) timeouts
+            if response.status_code == 304 and cached_page is not None:
+                _save_url_content(url_key, cached_page.content, response.headers, previous=cached_page)
+                return cached_page.content
+            response.raise_for_status()
+
+            # Refuse oversized bodies up front when the server tells us the size
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > MAX_CONTENT_BYTES:
+                raise ValueError(f"response of {content_length} bytes exceeds the {MAX_CONTENT_BYTES} byte limit")
+
+            # Sniff the format from the first chunk instead of trusting the Content-Type header
+            chunks = response.iter_content(chunk_size=65536)
+            body = bytearray(next(chunks, b""))
+            if body.startswith(BINARY_SIGNATURES) or body[4:8] == b"ftyp": # ftyp marks MP4/MOV/HEIC
+                raise ValueError("response is binary media, not a document")
+            is_pdf = b"%PDF" in body[:1024] # The PDF header may follow a little leading junk
+
+            # Otherwise read the rest of the body and stop once the cap is passed
+            for chunk in chunks:
+                body += chunk
+                if len(body) > MAX_CONTENT_BYTES:
+                    break
+            # Truncated HTML still parses, but a PDF loses its trailing cross-reference table
+            if is_pdf and len(body) > MAX_CONTENT_BYTES:
+                raise ValueError(f"PDF exceeds the {MAX_CONTENT_BYTES} byte limit")
+            del body[MAX_CONTENT_BYTES:]
+
+        if is_pdf:
+            text = extract_pdf_text(bytes(body))
         else:
-            text = trafilatura.extract(response.text)
-        
+            text = extract_html_text(body.decode(response.encoding or 'utf-8', errors='replace'))
+
+        if text:
+            _save_url_content(url_key, text, response.headers)
         return text
             
     except Exception as e:
         print(f"❗️ Gracefully skipping URL {url} due to error: {e}")
         return None
 
-def summarize_with_gemini(text: str, query: str):
-    """Uses Gemini to summarize the text into a structured report."""
-    if not text:
+# Per-source input budget for Gemini; tokens are estimated at ~4 characters each
+MAX_SOURCE_TOKENS = 30000
+CHARS_PER_TOKEN = 4
+PASSAGE_CHARS = 2000 # Long paragraphs are cut into passages of this size before ranking
+
+def _trim_to_token_budget(text: str, query: str):
+    """Keeps the passages most relevant to the query (by TF-IDF) when text exceeds the token budget."""
+    max_chars = MAX_SOURCE_TOKENS * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        passages.extend(paragraph[i:i + PASSAGE_CHARS] for i in range(0, len(paragraph), PASSAGE_CHARS))
+
+    query_terms = set(re.findall(r"\w+", query.lower()))
+    term_counts = [Counter(re.findall(r"\w+", passage.lower())) for passage in passages]
+    doc_freq = Counter(term for counts in term_counts for term in query_terms & counts.keys())
+    idf = {term: math.log((1 + len(passages)) / (1 + doc_freq[term])) + 1 for term in query_terms}
+
+    def score(i):
+        counts = term_counts[i]
+        return sum(counts[term] * idf[term] for term in query_terms) / (sum(counts.values()) or 1)
+
+    # Take the best-scoring passages that fit, then put them back in document order
+    kept, used = [], 0
+    for i in sorted(range(len(passages)), key=score, reverse=True):
+        if used + len(passages[i]) <= max_chars:
+            kept.append(i)
+            used += len(passages[i])
+    print(f"✂️  Trimmed source text from {len(text)} to {used} characters.")
+    return "\n\n".join(passages[i] for i in sorted(kept))
+
+def _summarize_source(text: str, query: str):
+    """Map step: condenses a single source into notes relevant to the query."""
+    prompt = PROMPT_TEMPLATE.format(query=query, text=text)
+    response = _gemini_model(NOTES_INSTRUCTIONS).generate_content(prompt)
+    return response.text
+
+def _summarize_sources(texts: list, query: str):
+    """Summarizes each source concurrently, then combines the notes into one report."""
+    texts = [_trim_to_token_budget(text, query) for text in texts]
+    if len(texts) == 1:
+        notes = texts # A single source goes straight to the report step
+    else:
+        with ThreadPoolExecutor(max_workers=len(texts)) as executor:
+            futures = [executor.submit(_summarize_source, text, query) for text in texts]
+        notes = [future.result() for future in futures if future.exception() is None and future.result()]
+        if not notes:
+            raise futures[0].exception() or ValueError("no notes were produced")
+
+    combined_notes = "\n---\n".join(notes)
+    prompt = PROMPT_TEMPLATE.format(query=query, text=combined_notes)
+    response = _gemini_model(REPORT_INSTRUCTIONS).generate_content(prompt)
+    return response.text
+
+@cached(is_cacheable=is_summary)
+def summarize_with_gemini(texts: list, query: str):
+    """Uses Gemini to summarize the extracted texts (one per source) into a structured report."""
+    if not texts:
         return "Error: No text was extracted for summarization."
     
-    print("🤖 Summarizing content with Gemini...")
-    prompt = f"""
-    Based on the following extracted text and the original user query, create a short, structured report.
-    The report must include:
-    1. A clear, relevant title.
-    2. A brief summary of the main topics.
-    3. A few key bullet points highlighting the most important findings.
-
-    Original User Query: "{query}"
-
-    Extracted Text:
-    ---
-    {text}
-    ---
-    """
+    print(f"🤖 Summarizing {len(texts)} sources with Gemini...")
     try:
-        response = gemini_model.generate_content(prompt)
-        return response.text
+        return _summarize_sources(texts, query)
     except Exception as e:
         return f"An error occurred during summarization: {e}"
 
 # --- NEW: Function to save report to the database ---
-def save_report_to_db(query: str, report_content: str, sources: list):
-    """Saves the generated report and its metadata to the SQLite database."""
+def _build_report(query: str, report_content: str, sources: list, query_embedding=None):
+    import numpy as np
+    return Report(
+        query=query,
+        report_content=report_content,
+        sources=sources,
+        embedding=None if query_embedding is None else query_embedding.astype(np.float16).tobytes()
+    )
+
+def save_report_to_db(query: str, report_content: str, sources: list, query_embedding=None):
+    """Saves the generated report and its metadata to the SQLite database, returning its id (None on failure)."""
     db = SessionLocal()
     try:
-        new_report = Report(
-            query=query,
-            report_content=report_content,
-            sources=", ".join(sources) # Join list of URLs into a single string
-        )
-        db.add(new_report)
+        report = _build_report(query, report_content, sources, query_embedding)
+        db.add(report)
         db.commit()
-        db.refresh(new_report)
         print(f"💾 Report for query '{query}' saved to database.")
+        return report.id
     except Exception as e:
         print(f"Error saving report to database: {e}")
         db.rollback()
+        return None
+    finally:
+        db.close()
+
+def save_reports_to_db(items: list):
+    """Saves many (query, report_content, sources, query_embedding) tuples in a single transaction."""
+    db = SessionLocal()
+    try:
+        db.add_all([_build_report(*item) for item in items])
+        db.commit() # One commit (and one fsync) for the whole batch
+        print(f"💾 {len(items)} reports saved to database.")
+    except Exception as e:
+        print(f"Error saving reports to database: {e}")
+        db.rollback()
     finally:
         db.close()
 # --- END NEW SECTION ---
@@ -132,25 +401,38 @@ def save_report_to_db(query: str, report_content: str, sources: list):
 
 # --- 3. MAIN WORKFLOW ---
 
-def run_agent(query: str):
-    """The main function that orchestrates the agent's workflow."""
-    urls = search_online(query)
+def run_agent(query: str, save: bool = True):
+    """The main function that orchestrates the agent's workflow.
+
+    Returns the (query, report, sources, query_embedding) tuple for a newly generated
+    report; it is written to the database right away unless save is False.
+    """
+    # Reuse a previous report if it answered a near-identical query
+    query_embedding = embed_query(query)
+    if query_embedding is not None:
+        similar_report = find_similar_report(query_embedding)
+        if similar_report is not None:
+            print(f"♻️  Reusing saved report for similar query: '{similar_report.query}'")
+            print("\n\n--- ✅ FINAL REPORT ---")
+            print(similar_report.report_content)
+            return
+
+    # Drop duplicate URLs, keeping the search ranking order
+    urls = list(dict.fromkeys(search_online(query)))
     
     if not urls:
         print("Could not find any relevant URLs. Exiting.")
         return
 
-    all_content = ""
-    for url in urls:
-        content = extract_content_from_url(url)
-        if content:
-            all_content += content + "\n\n"
+    # Scrape all URLs concurrently; the work is network-bound, so threads overlap the waits
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        contents = [content for content in executor.map(extract_content_from_url, urls) if content]
             
-    if not all_content:
+    if not contents:
         print("Failed to extract content from any of the URLs. Exiting.")
         return
         
-    final_report = summarize_with_gemini(all_content, query)
+    final_report = summarize_with_gemini(contents, query)
     
     print("\n\n--- ✅ FINAL REPORT ---")
     print(final_report)
@@ -159,12 +441,22 @@ def run_agent(query: str):
         print(f"- {url}")
         
     # --- NEW: Save the report ---
-    if final_report:
-        save_report_to_db(query, final_report, urls)
+    # Failed summaries are never saved or returned, or the semantic cache would keep serving the error
+    if is_summary(final_report):
+        if save:
+            save_report_to_db(query, final_report, urls, query_embedding)
+        return query, final_report, urls, query_embedding
     # --- END NEW SECTION ---
 
+def run_agents(queries: list):
+    """Runs the agent over several queries and saves all new reports in one batch."""
+    results = [result for query in queries if (result := run_agent(query, save=False))]
+    if results:
+        save_reports_to_db(results)
+
 
 # --- EXECUTION ---
 if __name__ == '__main__':
+    setup()
     user_query = "Impact of Mediterranean diet on heart health"
     run_agent(user_query)
\ No newline at end of file
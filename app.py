@@ -1,115 +1,92 @@
 # app.py
-import os
-import io
-import requests
-import pypdf
-import trafilatura
-import google.generativeai as genai
-from tavily import TavilyClient
-from dotenv import load_dotenv
-from datetime import datetime
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, render_template, abort, request, redirect, url_for
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
-from sqlalchemy.orm import declarative_base, sessionmaker
+from flask import Flask, render_template, abort, request, redirect, url_for, jsonify
+from db import SessionLocal, Report
 
 # --- 1. SETUP ---
-# Load environment variables and configure API clients
-load_dotenv()
-try:
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-except TypeError:
-    print("Error: API key not found. Make sure GEMINI_API_KEY and TAVILY_API_KEY are in your .env file.")
-    exit()
+# The agent core (API clients, caches, scraping, summarization) lives in agent.py
+from agent import (setup, embed_query, find_similar_report, search_online, extract_content_from_url,
+                   summarize_with_gemini, save_report_to_db, is_summary)
 
-# Configure Database
-DATABASE_URL = "sqlite:///research_reports.db"
-engine = create_engine(DATABASE_URL)
-Base = declarative_base()
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-class Report(Base):
-    __tablename__ = "reports"
-    id = Column(Integer, primary_key=True, index=True)
-    query = Column(String, index=True)
-    report_content = Column(Text)
-    sources = Column(Text)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-
-Base.metadata.create_all(bind=engine)
+# Load the .env file, check the API keys and create or upgrade the database schema
+setup()
 
 # --- 2. AGENT CORE LOGIC ---
-# These functions are the core of the research agent
-def search_online(query: str, max_results=3):
-    print(f"🔎 Searching online for: '{query}'...")
-    try:
-        response = tavily_client.search(query=query, search_depth="basic", max_results=max_results)
-        return [obj["url"] for obj in response["results"]]
-    except Exception as e:
-        print(f"Error during online search: {e}")
-        return []
+# The web flavour of agent.run_agent: reports progress and returns the report id instead of printing
+def run_agent(query: str, on_status=lambda status: None):
+    # Returns the id of the report answering the query (None on failure); on_status receives progress updates
+    # Skip the whole pipeline when a saved report already answers a near-identical query
+    query_embedding = embed_query(query)
+    if query_embedding is not None:
+        similar_report = find_similar_report(query_embedding)
+        if similar_report is not None: return similar_report.id
+    on_status("searching")
+    urls = list(dict.fromkeys(search_online(query))) # Dedupe, keeping ranking order
+    if not urls: return None
+    on_status("scraping")
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        contents = [content for content in executor.map(extract_content_from_url, urls) if content]
+    if not contents: return None
+    on_status("summarizing")
+    final_report = summarize_with_gemini(contents, query)
+    if is_summary(final_report): # Never save (and embed) an error message as a report
+        return save_report_to_db(query, final_report, urls, query_embedding)
+    return None
 
-def extract_content_from_url(url: str):
-    print(f"🕸️  Scraping content from: {url}...")
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'}
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        if 'application/pdf' in response.headers.get('Content-Type', ''):
-            with io.BytesIO(response.content) as f:
-                reader = pypdf.PdfReader(f)
-                text = "".join(page.extract_text() for page in reader.pages)
-        else:
-            text = trafilatura.extract(response.text)
-        return text
-    except Exception as e:
-        print(f"❗️ Gracefully skipping URL {url} due to error: {e}")
-        return None
+# --- BACKGROUND JOBS ---
+# Agent runs take 30-60s, so they go to a worker pool instead of holding the request thread
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+MAX_TRACKED_JOBS = 100
+JOBS = {} # job id -> {"query": ..., "status": ..., "report_id": ...}, oldest first
+JOBS_LOCK = threading.Lock()
 
-def summarize_with_gemini(text: str, query: str):
-    if not text: return "Error: No text for summarization."
-    print("🤖 Summarizing content with Gemini...")
-    prompt = f"""
-    Based on the following extracted text and the original user query, create a short, structured report.
-    The report must include: A clear title, a brief summary, and a few key bullet points.
-    Original User Query: "{query}"
-    Extracted Text: --- {text} --- """
-    try:
-        response = gemini_model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        return f"An error occurred during summarization: {e}"
+def _set_job_status(job_id: str, status: str, **fields):
+    with JOBS_LOCK:
+        JOBS[job_id].update(status=status, **fields)
 
-def save_report_to_db(query: str, report_content: str, sources: list):
-    db = SessionLocal()
+def _run_job(job_id: str, query: str):
     try:
-        new_report = Report(query=query, report_content=report_content, sources=", ".join(sources))
-        db.add(new_report)
-        db.commit()
-        print(f"💾 Report for query '{query}' saved to database.")
-    finally:
-        db.close()
+        report_id = run_agent(query, on_status=lambda status: _set_job_status(job_id, status))
+    except Exception as e:
+        print(f"Error while running agent for '{query}': {e}")
+        report_id = None
+    if report_id is None:
+        _set_job_status(job_id, "failed")
+    else:
+        _set_job_status(job_id, "done", report_id=report_id)
 
-def run_agent(query: str):
-    urls = search_online(query)
-    if not urls: return
-    all_content = "".join([content for url in urls if (content := extract_content_from_url(url))])
-    if not all_content: return
-    final_report = summarize_with_gemini(all_content, query)
-    if final_report and not final_report.startswith("Error:"):
-        save_report_to_db(query, final_report, urls)
+def submit_job(query: str):
+    job_id = uuid.uuid4().hex
+    with JOBS_LOCK:
+        # Forget the oldest finished jobs so the registry stays bounded
+        finished = [old_id for old_id, job in JOBS.items() if job["status"] in ("done", "failed")]
+        for old_id in finished[:max(len(JOBS) - MAX_TRACKED_JOBS + 1, 0)]:
+            del JOBS[old_id]
+        JOBS[job_id] = {"query": query, "status": "queued", "report_id": None}
+    EXECUTOR.submit(_run_job, job_id, query)
+    return job_id
 
 # --- 3. FLASK WEB APP ---
 app = Flask(__name__)
 
+REPORTS_PER_PAGE = 50
+
 @app.route("/")
 def index():
+    page = max(request.args.get("page", 1, type=int), 1)
     db = SessionLocal()
-    reports = db.query(Report).order_by(Report.timestamp.desc()).all()
+    # Only the columns the history list shows; fetch one extra row to know whether a next page exists
+    reports = (db.query(Report.id, Report.query, Report.timestamp)
+               .order_by(Report.timestamp.desc())
+               .offset((page - 1) * REPORTS_PER_PAGE).limit(REPORTS_PER_PAGE + 1).all())
     db.close()
-    return render_template("index.html", reports=reports)
+    has_next = len(reports) > REPORTS_PER_PAGE
+    job_id = request.args.get("job")
+    return render_template("index.html", reports=reports[:REPORTS_PER_PAGE], page=page, has_next=has_next,
+                           job_id=job_id if job_id in JOBS else None)
 
 @app.route("/report/<int:report_id>")
 def report(report_id):
@@ -117,12 +94,21 @@ def report(report_id):
     single_report = db.query(Report).filter(Report.id == report_id).first()
     db.close()
     if single_report is None: abort(404)
-    sources_list = single_report.sources.split(", ")
-    return render_template("report.html", report=single_report, sources=sources_list)
+    return render_template("report.html", report=single_report, sources=single_report.sources or [])
 
 @app.route("/run", methods=["POST"])
 def run():
     query = request.form.get("query")
-    if query:
-        run_agent(query)
-    return redirect(url_for('index'))
\ No newline at end of file
+    if not query:
+        return redirect(url_for('index'))
+    job_id = submit_job(query)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job_id=job_id, status_url=url_for('status', job_id=job_id)), 202
+    return redirect(url_for('index', job=job_id))
+
+@app.route("/status/<job_id>")
+def status(job_id):
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+        if job is None: abort(404)
+        return jsonify(job_id=job_id, **job)
@@ -0,0 +1,91 @@
+# db.py
+# Database schema and setup shared by agent.py and app.py
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, DateTime, LargeBinary, JSON
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.types import TypeDecorator
+
+# Define the database connection
+DATABASE_URL = "sqlite:///research_reports.db"
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+# Use WAL journaling so commits are cheap and the web app can read while the agent writes
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.close()
+
+Base = declarative_base()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# Large text columns are stored zlib-compressed; rows written before compression are plain text
+class CompressedText(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else zlib.compress(value.encode("utf-8"), 6)
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return zlib.decompress(value).decode("utf-8")
+
+# Define the Report table model
+class Report(Base):
+    __tablename__ = "reports"
+    id = Column(Integer, primary_key=True, index=True)
+    query = Column(String, index=True)
+    report_content = Column(CompressedText)
+    sources = Column(JSON) # List of source URLs, stored as JSON text
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    embedding = Column(LargeBinary, nullable=True) # float16 query embedding for semantic lookups
+
+# Define the cache table for search results and summaries
+class CacheEntry(Base):
+    __tablename__ = "cache"
+    key = Column(String, primary_key=True) # sha256 of the function name and its arguments
+    value = Column(CompressedText) # JSON-encoded return value
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Define the table of previously scraped page text, keyed by URL
+class UrlCacheEntry(Base):
+    __tablename__ = "url_cache"
+    url_sha256 = Column(String, primary_key=True)
+    content = Column(CompressedText)
+    fetched_at = Column(DateTime, default=datetime.utcnow)
+    etag = Column(String, nullable=True) # Validators for conditional re-fetches
+    last_modified = Column(String, nullable=True)
+
+# Bump whenever the schema changes; the database records the version it was last set up for
+SCHEMA_VERSION = 4
+
+def init_db():
+    """Creates or upgrades the tables, skipping the DDL when the database is already up to date."""
+    with engine.connect() as conn:
+        if conn.execute(text("PRAGMA user_version")).scalar() >= SCHEMA_VERSION:
+            return
+
+    # Create the tables in the database if they don't exist
+    Base.metadata.create_all(bind=engine)
+
+    # create_all does not alter existing tables, so add columns introduced after the first release
+    with engine.begin() as conn:
+        if "embedding" not in {column["name"] for column in inspect(conn).get_columns("reports")}:
+            conn.execute(text("ALTER TABLE reports ADD COLUMN embedding BLOB"))
+        # Likewise for indexes added to existing tables
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_reports_timestamp ON reports (timestamp)"))
+        # Sources used to be stored as a comma-separated string; rewrite those rows as JSON lists
+        legacy = conn.execute(text("SELECT id, sources FROM reports WHERE sources IS NOT NULL AND NOT json_valid(sources)")).all()
+        if legacy:
+            conn.execute(text("UPDATE reports SET sources = :sources WHERE id = :id"),
+                         [{"id": row.id, "sources": json.dumps(row.sources.split(", "))} for row in legacy])
+        conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
@@ -0,0 +1,61 @@
+# pdf_text.py
+# PDF text extraction shared by agent.py and app.py. Spawned workers import this module and pypdf;
+# they also re-run the script that started the parent as __mp_main__ (e.g. agent.py), so that
+# script must keep its setup out of module level.
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# PDFs with at least this many pages have their text extracted across worker processes
+PDF_PARALLEL_MIN_PAGES = 20
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    """Returns the shared process pool used for PDF text extraction, creating it on first use."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn rather than fork: forking a process with live gRPC and scraper threads is unsafe
+            _pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+def _discard_pdf_pool(pool):
+    """Forgets a broken pool, unless another thread has already replaced it."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+def _extract_pdf_pages(pdf_bytes: bytes, start: int, stop: int):
+    """Extracts the text of pages [start, stop) from a PDF; runs in a worker process."""
+    import pypdf
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    return "".join(reader.pages[i].extract_text() for i in range(start, stop))
+
+def extract_pdf_text(pdf_bytes: bytes):
+    """Extracts the text of a PDF, splitting large documents into page ranges across CPU cores."""
+    import pypdf
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    page_count = len(reader.pages)
+    workers = os.cpu_count() or 1
+    if page_count < PDF_PARALLEL_MIN_PAGES or workers < 2:
+        return "".join(page.extract_text() for page in reader.pages)
+
+    # Page objects can't be shipped to other processes, so each worker re-opens the PDF for its own range
+    step = -(-page_count // workers)
+    starts = range(0, page_count, step)
+    stops = [min(start + step, page_count) for start in starts]
+    pool = _get_pdf_pool()
+    try:
+        return "".join(pool.map(_extract_pdf_pages, [pdf_bytes] * len(starts), starts, stops))
+    except BrokenProcessPool as e:
+        # A worker died (e.g. killed for memory); drop the pool so the next PDF starts a fresh one
+        print(f"PDF worker pool failed, extracting in-process instead: {e}")
+        _discard_pdf_pool(pool)
+        return "".join(page.extract_text() for page in reader.pages)